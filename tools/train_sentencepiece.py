@@ -16,19 +16,39 @@
 """Build a SentencePiece vocabulary for RWKV preprocessing."""
 
 import argparse
+import heapq
 import json
+import mmap
+import multiprocessing
 import os
+import random
+import shutil
 import sys
 import tempfile
+from itertools import chain
 from pathlib import Path
-from typing import Iterator, List, Optional
+from typing import Iterator, List, Optional, Tuple
 
 import sentencepiece as spm
 
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
 
 # Default total vocabulary size
 DEFAULT_VOCAB_SIZE = 65536
 
+# Flush threshold for buffered shard writes (4 MB)
+WRITE_BUFFER_SIZE = 1 << 22
+
+# Bloom filter sizing for --dedup
+DEDUP_CAPACITY = 1_000_000_000
+DEDUP_ERROR_RATE = 1e-4
+
 
 def get_args():
     parser = argparse.ArgumentParser(
@@ -90,15 +110,10 @@ def get_args():
     )
     group.add_argument(
         "--byte-fallback",
-        action="store_true",
+        action=argparse.BooleanOptionalAction,
         default=True,
         help="Enable byte fallback for unknown characters. Default: enabled",
     )
-    group.add_argument(
-        "--no-byte-fallback",
-        action="store_true",
-        help="Disable byte fallback for unknown characters.",
-    )
 
     group = parser.add_argument_group(title="special tokens")
     group.add_argument(
@@ -128,6 +143,12 @@ def get_args():
         default=1000000,
         help="Seed sentencepiece size. Default: 1000000",
     )
+    group.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Drop duplicate lines via a Bloom filter before training. "
+        "Requires the pybloomfiltermmap3 package.",
+    )
     group.add_argument(
         "--num-threads",
         type=int,
@@ -140,45 +161,104 @@ def get_args():
         help="Enable for extremely large corpus (may use more memory).",
     )
 
-    args = parser.parse_args()
-
-    # Handle byte_fallback logic
-    if args.no_byte_fallback:
-        args.byte_fallback = False
-
-    return args
-
-
-def read_txt_file(filepath: str) -> Iterator[str]:
-    """Read lines from a text file."""
-    with open(filepath, "r", encoding="utf-8") as f:
+    return parser.parse_args()
+
+
+def read_txt_file(filepath: str) -> Iterator[bytes]:
+    """Read lines from a text file via mmap, avoiding per-line read() calls.
+
+    Lines stay as raw bytes all the way to the shard writer / trainer, so
+    no UTF-8 decode is paid on this path.
+    """
+    with open(filepath, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            pos = 0
+            size = len(mm)
+            while pos < size:
+                nl = mm.find(b"\n", pos)
+                if nl == -1:
+                    nl = size
+                line = mm[pos:nl].rstrip(b"\r\n\t ")
+                pos = nl + 1
+                if line:
+                    yield line
+
+
+_MISSING = object()
+
+
+def _emit_jsonl_value(text) -> Iterator[bytes]:
+    """Yield text fragments from one record value (generic path)."""
+    if isinstance(text, str) and text.strip():
+        yield text.strip().encode("utf-8")
+    elif isinstance(text, list):
+        # Handle SSG protocol format
+        for item in text:
+            if isinstance(item, dict):
+                for v in item.values():
+                    if isinstance(v, str) and v.strip():
+                        yield v.strip().encode("utf-8")
+
+
+def read_jsonl_file(filepath: str, key: str) -> Iterator[bytes]:
+    """Read text from a JSONL file.
+
+    The schema is fixed per file, so the first record is sniffed once and
+    the remaining lines run through a loop specialized for its shape
+    (plain str value or SSG protocol list), skipping the per-line
+    isinstance dispatch of the generic path.
+    """
+    with open(filepath, "rb") as f:
+        # Sniff the first record that carries the key
+        first = _MISSING
         for line in f:
-            line = line.strip()
-            if line:
-                yield line
-
-
-def read_jsonl_file(filepath: str, key: str) -> Iterator[str]:
-    """Read text from a JSONL file."""
-    with open(filepath, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if line:
+            try:
+                # orjson parses bytes directly and tolerates surrounding
+                # whitespace, so no strip/decode round trip is needed.
+                data = _loads(line)
+            except ValueError:
+                # json.JSONDecodeError and orjson.JSONDecodeError are both
+                # ValueError subclasses; blank lines land here too.
+                continue
+            if key in data:
+                first = data[key]
+                break
+        if first is _MISSING:
+            return
+        yield from _emit_jsonl_value(first)
+
+        if isinstance(first, str):
+            for line in f:
                 try:
-                    data = json.loads(line)
-                    if key in data:
-                        text = data[key]
-                        if isinstance(text, str) and text.strip():
-                            yield text.strip()
-                        elif isinstance(text, list):
-                            # Handle SSG protocol format
-                            for item in text:
-                                if isinstance(item, dict):
-                                    for v in item.values():
-                                        if isinstance(v, str) and v.strip():
-                                            yield v.strip()
-                except json.JSONDecodeError:
+                    text = _loads(line)[key]
+                except (ValueError, KeyError, TypeError):
                     continue
+                if isinstance(text, str) and text.strip():
+                    yield text.strip().encode("utf-8")
+        elif isinstance(first, list):
+            for line in f:
+                try:
+                    items = _loads(line)[key]
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if isinstance(items, list):
+                    for item in items:
+                        if isinstance(item, dict):
+                            for v in item.values():
+                                if isinstance(v, str) and v.strip():
+                                    yield v.strip().encode("utf-8")
+        else:
+            for line in f:
+                try:
+                    data = _loads(line)
+                except ValueError:
+                    continue
+                if key in data:
+                    yield from _emit_jsonl_value(data[key])
 
 
 def get_input_files(input_paths: str) -> List[str]:
@@ -189,17 +269,22 @@ def get_input_files(input_paths: str) -> List[str]:
         if not path:
             continue
 
-        p = Path(path)
-        if p.is_file():
-            files.append(str(p))
-        elif p.is_dir():
-            # Recursively find all .txt and .jsonl files
-            files.extend(str(f) for f in p.rglob("*.txt"))
-            files.extend(str(f) for f in p.rglob("*.jsonl"))
+        if os.path.isfile(path):
+            files.append(path)
+        elif os.path.isdir(path):
+            # Recursively find all .txt and .jsonl files in one traversal
+            for root, _, names in os.walk(path):
+                files.extend(
+                    os.path.join(root, name)
+                    for name in names
+                    if name.endswith((".txt", ".jsonl"))
+                )
         else:
             print(f"Warning: Path not found: {path}", file=sys.stderr)
 
-    return sorted(set(files))
+    # O(N) order-preserving dedup; keeps the user's path order instead of
+    # re-sorting millions of entries
+    return list(dict.fromkeys(files))
 
 
 def detect_format(filepath: str, default_format: str) -> str:
@@ -214,30 +299,110 @@ def detect_format(filepath: str, default_format: str) -> str:
         return "txt"
 
 
-def collect_text_to_file(
+def read_file(filepath: str, input_format: str, jsonl_key: str) -> Iterator[bytes]:
+    """Read text lines from a single input file as UTF-8 bytes."""
+    fmt = detect_format(filepath, input_format)
+    print(f"Processing: {filepath} (format: {fmt})")
+
+    if fmt == "jsonl":
+        return read_jsonl_file(filepath, jsonl_key)
+    else:
+        return read_txt_file(filepath)
+
+
+def iter_corpus(
     input_files: List[str],
     input_format: str,
     jsonl_key: str,
-    output_file: str,
-) -> int:
-    """Collect all text from input files into a single file for training."""
-    total_lines = 0
+) -> Iterator[bytes]:
+    """Chain all input files into a single stream of text lines."""
+    return chain.from_iterable(
+        read_file(filepath, input_format, jsonl_key) for filepath in input_files
+    )
 
-    with open(output_file, "w", encoding="utf-8") as out:
-        for filepath in input_files:
-            fmt = detect_format(filepath, input_format)
-            print(f"Processing: {filepath} (format: {fmt})")
 
-            if fmt == "jsonl":
-                iterator = read_jsonl_file(filepath, jsonl_key)
-            else:
-                iterator = read_txt_file(filepath)
+def dedup_lines(iterator: Iterator[bytes]) -> Iterator[bytes]:
+    """Drop lines already seen, using a Bloom filter as the seen-set.
 
-            for line in iterator:
-                out.write(line + "\n")
-                total_lines += 1
+    A false positive (rate ~1e-4) drops a unique line, which is harmless
+    for vocabulary training.
+    """
+    try:
+        from pybloomfilter import BloomFilter
+    except ImportError:
+        print(
+            "Error: --dedup requires the pybloomfiltermmap3 package.",
+            file=sys.stderr,
+        )
+        sys.exit(1)
 
-    return total_lines
+    bf = BloomFilter(DEDUP_CAPACITY, DEDUP_ERROR_RATE)
+    for line in iterator:
+        # add() returns True when the element was (probably) already present
+        if not bf.add(line):
+            yield line
+
+
+def reservoir_sample(iterator: Iterator[bytes], k: int) -> List[bytes]:
+    """Uniformly sample up to k lines from a stream (Algorithm R)."""
+    sample = []
+    for i, line in enumerate(iterator):
+        if i < k:
+            sample.append(line)
+        else:
+            j = random.randrange(i + 1)
+            if j < k:
+                sample[j] = line
+    return sample
+
+
+def pack_shards(input_files: List[str], num_shards: int) -> List[List[str]]:
+    """Balance input files into num_shards groups by byte size (LPT greedy).
+
+    Assigning files largest-first to the currently lightest group bounds
+    parallel ingest by the heaviest group instead of whatever a round-robin
+    assignment produces on skewed file sizes.
+    """
+    sized = sorted(((os.path.getsize(f), f) for f in input_files), reverse=True)
+    heap = [(0, i) for i in range(num_shards)]
+    shards: List[List[str]] = [[] for _ in range(num_shards)]
+    for size, filepath in sized:
+        total, i = heapq.heappop(heap)
+        shards[i].append(filepath)
+        heapq.heappush(heap, (total + size, i))
+    return [shard for shard in shards if shard]
+
+
+def _write_shard(
+    filepaths: List[str],
+    input_format: str,
+    jsonl_key: str,
+    shard_path: str,
+) -> Tuple[str, int]:
+    """Write a group of input files' text to a shard (run in a worker process)."""
+    total_lines = 0
+    buf = bytearray()
+    # Raw descriptor: shard writes are already large aligned chunks, so the
+    # default TextIOWrapper/BufferedWriter layers would only add copies and
+    # extra small write() syscalls
+    fd = os.open(shard_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        for filepath in filepaths:
+            for line in read_file(filepath, input_format, jsonl_key):
+                buf += line
+                buf += b"\n"
+                if len(buf) >= WRITE_BUFFER_SIZE:
+                    # Count lines per flushed chunk (C-level memchr) instead
+                    # of incrementing in the per-line hot loop
+                    total_lines += buf.count(b"\n")
+                    os.write(fd, buf)
+                    buf.clear()
+        if buf:
+            total_lines += buf.count(b"\n")
+            os.write(fd, buf)
+    finally:
+        os.close(fd)
+    return shard_path, total_lines
 
 
 def load_special_tokens(filepath: Optional[str]) -> List[str]:
@@ -245,13 +410,8 @@ def load_special_tokens(filepath: Optional[str]) -> List[str]:
     if filepath is None:
         return []
 
-    tokens = []
     with open(filepath, "r", encoding="utf-8") as f:
-        for line in f:
-            token = line.strip()
-            if token:
-                tokens.append(token)
-    return tokens
+        return [token for line in f if (token := line.strip())]
 
 
 def main():
@@ -294,17 +454,57 @@ def main():
     if output_dir and not output_dir.exists():
         output_dir.mkdir(parents=True)
 
-    # Collect all text into a temporary file
-    with tempfile.NamedTemporaryFile(
-        mode="w", suffix=".txt", delete=False, encoding="utf-8"
-    ) as tmp:
-        tmp_path = tmp.name
-
+    tmp_dir = None
     try:
-        total_lines = collect_text_to_file(
-            input_files, args.input_format, args.jsonl_key, tmp_path
-        )
-        print(f"Collected {total_lines} lines of text")
+        if args.dedup or args.input_sentence_size > 0:
+            # Deduplication and sampling both need a single global view of the
+            # corpus, so these paths stream straight to the trainer instead of
+            # writing shards.
+            corpus = iter_corpus(input_files, args.input_format, args.jsonl_key)
+            if args.dedup:
+                corpus = dedup_lines(corpus)
+            if args.input_sentence_size > 0:
+                # Sample in the reader so lines beyond the budget are never
+                # materialized; SentencePiece would otherwise read the whole
+                # corpus before sampling.
+                sample = reservoir_sample(corpus, args.input_sentence_size)
+                total_lines = len(sample)
+                input_args = {"sentence_iterator": iter(sample)}
+                print(f"Collected {total_lines} lines of text (sampled)")
+            else:
+                # Line count is only known after training here; peek one line
+                # for the empty-corpus check
+                try:
+                    first_line = next(corpus)
+                except StopIteration:
+                    print("Error: No text found in input files.", file=sys.stderr)
+                    sys.exit(1)
+                total_lines = 1
+                input_args = {"sentence_iterator": chain([first_line], corpus)}
+                print("Streaming deduplicated corpus to the trainer")
+        else:
+            # Decode input files in parallel, packed into size-balanced shards;
+            # SentencePiece accepts a comma-separated file list as input
+            tmp_dir = tempfile.mkdtemp(prefix="spm_corpus_")
+            num_workers = min(args.num_threads, len(input_files))
+            shard_groups = pack_shards(input_files, num_workers)
+            with multiprocessing.Pool(len(shard_groups)) as pool:
+                results = pool.starmap(
+                    _write_shard,
+                    [
+                        (
+                            group,
+                            args.input_format,
+                            args.jsonl_key,
+                            os.path.join(tmp_dir, f"shard_{i}.txt"),
+                        )
+                        for i, group in enumerate(shard_groups)
+                    ],
+                )
+            shards = [shard_path for shard_path, _ in results]
+            total_lines = sum(count for _, count in results)
+            input_args = {"input": ",".join(shards)}
+            print(f"Collected {total_lines} lines of text")
 
         if total_lines == 0:
             print("Error: No text found in input files.", file=sys.stderr)
@@ -312,7 +512,7 @@ def main():
 
         # Build SentencePiece training arguments
         train_args = {
-            "input": tmp_path,
+            **input_args,
             "model_prefix": args.model_prefix,
             "vocab_size": sp_vocab_size,
             "model_type": args.model_type,
@@ -322,10 +522,8 @@ def main():
             "seed_sentencepiece_size": args.seed_sentencepiece_size,
         }
 
-        # Add optional arguments
-        if args.input_sentence_size > 0:
-            train_args["input_sentence_size"] = args.input_sentence_size
-
+        # Add optional arguments (input_sentence_size is already applied
+        # by the reservoir sample above)
         if args.shuffle_input_sentence:
             train_args["shuffle_input_sentence"] = True
 
@@ -349,9 +547,11 @@ def main():
         print(f"  {args.model_prefix}.model")
         print(f"  {args.model_prefix}.vocab")
 
-        # Verify the model
-        sp = spm.SentencePieceProcessor()
-        sp.load(f"{args.model_prefix}.model")
+        # Verify the model; feed the proto through an mmap'd view so the
+        # kernel page cache is shared with later consumers of the file
+        with open(f"{args.model_prefix}.model", "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                sp = spm.SentencePieceProcessor(model_proto=bytes(mm))
         actual_vocab_size = sp.get_piece_size()
 
         print(f"\nModel verification:")
@@ -363,17 +563,17 @@ def main():
         print(f"  EOS ID: {sp.eos_id()}")
         print(f"  PAD ID: {sp.pad_id()}")
 
-        # Show user-defined special token IDs
+        # Show user-defined special token IDs; piece_to_id accepts a list
+        # and resolves it in one C++ call
         if special_tokens:
             print(f"\nUser-defined special token IDs:")
-            for token in special_tokens:
-                token_id = sp.piece_to_id(token)
+            token_ids = sp.piece_to_id(special_tokens)
+            for token, token_id in zip(special_tokens, token_ids):
                 print(f"  {token}: {token_id}")
-
     finally:
-        # Clean up temporary file
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
+        # Clean up shard files
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
 
 
 if __name__ == "__main__":